@@ -0,0 +1,105 @@
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import formatting
+
+# Release files are named e.g. TxAntennaDAB_2023-01.csv / TxParamsDAB_2023-01.csv
+ANTENNA_PATTERN = re.compile(r'^txantennadab(?P<release>.*)\.csv$', re.IGNORECASE)
+PARAMS_PATTERN = re.compile(r'^txparamsdab(?P<release>.*)\.csv$', re.IGNORECASE)
+
+
+def get_release_name(match):
+    """Extract the release tag from a matched file name"""
+    # Strip the separators between the dataset name and the release
+    return match.group('release').strip(' _-.')
+
+
+def pair_release_files(directory):
+    """
+    Pair the Antenna and Params csv files in a directory by
+    their shared release tag and return {release: (antenna, params)}
+    """
+    antenna_files = {}
+    params_files = {}
+    for file_name in sorted(os.listdir(directory)):
+        file_path = os.path.join(directory, file_name)
+        if not os.path.isfile(file_path):
+            continue
+        antenna_match = ANTENNA_PATTERN.match(file_name)
+        params_match = PARAMS_PATTERN.match(file_name)
+        if antenna_match:
+            antenna_files[get_release_name(antenna_match)] = file_path
+        elif params_match:
+            params_files[get_release_name(params_match)] = file_path
+    # Report files that cannot be matched with their counterpart
+    for release in antenna_files.keys() ^ params_files.keys():
+        print(f"Skipping release '{release}': missing Antenna or Params file")
+    return {
+        release: (antenna_files[release], params_files[release])
+        for release in sorted(antenna_files.keys() & params_files.keys())
+    }
+
+
+def tag_release(upload_data, release):
+    """
+    Tag each document with its release. The station id is only unique
+    within a release so it is prefixed with the release for the _id.
+    Fingerprints are combined with the release so an unchanged station
+    is kept in every release but not stored twice for one release
+    """
+    fingerprints = formatting.get_release_fingerprints(
+        [entry['_fingerprint'] for entry in upload_data], release
+    )
+    return [
+        {
+            **entry,
+            '_id': f"{release}-{entry['_id']}",
+            'Release': release,
+            '_fingerprint': int(fingerprint),
+        }
+        for entry, fingerprint in zip(upload_data, fingerprints)
+    ]
+
+
+def format_release(release, antenna_path, params_path):
+    """
+    Run the formatting pipeline for one release, used in worker processes.
+    Returns the tagged documents and the rejected rows and their report
+    """
+    # Each release is formatted once, so the stage outputs are not cached
+    upload_data, rejected = formatting.handler(
+        antenna_path, params_path, cache=False
+    )
+    return tag_release(upload_data, release), rejected
+
+
+def handler(directory, max_workers=None):
+    """
+    Format every release in the directory concurrently, so the total
+    time is close to the slowest release. Returns the merged documents,
+    {release: error} for the releases which failed and
+    {release: (rejected rows, report path)} for those with rejected rows
+    """
+    release_files = pair_release_files(directory)
+    upload_data = []
+    failures = {}
+    rejections = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(format_release, release, *paths): release
+            for release, paths in release_files.items()
+        }
+        # Merge the results as each release finishes
+        for future in as_completed(futures):
+            release = futures[future]
+            try:
+                release_data, rejected = future.result()
+            except Exception as e:
+                print(f"Unable to format release '{release}': {e}")
+                failures[release] = e
+                continue
+            upload_data.extend(release_data)
+            if rejected[0]:
+                rejections[release] = rejected
+    return upload_data, failures, rejections
@@ -1,79 +1,161 @@
+import codecs
+import hashlib
+import io
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
 import pandas as pd
 import numpy as np
 
+import mongodb_interaction
+import validation
 
-def custom_decode(file_path):
-    """Resolve decoding error by encoding the dataset in utf-8"""
-    # Get relevant path variables
-    file_ext_index = file_path.rfind('.')
-    file_name_index = file_path.rfind('/') + 1
-    # Slice the file_path string to extract the file name
-    file_name = file_path[file_name_index:file_ext_index]
+# Initialise list of required columns from antenna data
+ANTENNA_COLS = [
+    'id', 'NGR', 'Site Height',
+    'In-Use Ae Ht', 'In-Use ERP Total'
+]
+# Initialise list of station columns required for output,
+# the DAB multiplex flag columns follow NGR
+STATION_COLUMNS = [
+    'id', 'NGR', 'Site', 'Site Height',
+    'Aerial height(m)', 'Power(kW)', 'Date', 'Freq',
+    'Block', 'Serv Label1', 'Serv Label2', 'Serv Label3',
+    'Serv Label4', 'Serv Label10',
+]
+# Specify invalid NGRs to drop records
+INVALID_NGR = ('NZ02553847', 'SE213515', 'NT05399374', 'NT25265908')
+# Initialise list of required DAB multiplexes
+DAB_MULTIPLEXES = ('C18A', 'C18F', 'C188')
+# Default configuration of the pipeline stages
+DEFAULT_CONFIG = {
+    'invalid_ngr': INVALID_NGR,
+    'dab_multiplexes': DAB_MULTIPLEXES,
+}
+
+# Outputs of the pipeline stages keyed by their inputs and configuration
+stage_cache = OrderedDict()
+STAGE_CACHE_SIZE = 32
+
+
+def detect_encoding(raw_bytes, sample_size=65536):
+    """Sniff the encoding of the raw file bytes from a sample"""
+    if raw_bytes.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    # Decode incrementally so a character split by the sample is allowed
+    decoder = codecs.getincrementaldecoder('utf-8')()
     try:
-        # First assume the csv is utf-8 encoded
-        df = pd.read_csv(file_path, dtype='str')
+        decoder.decode(raw_bytes[:sample_size], final=False)
     except UnicodeDecodeError:
-        try:
-            # If not utf-8, assume ISO-8859-1 encoding
-            df = pd.read_csv(file_path, dtype='str', encoding='latin-1')
-        except Exception as e:
-            print(f"Unable to parse {file_name} dataset: {e}")
-            raise pd.errors.ParserError("Failed to parse the dataset")
-    except Exception as e:
-        print(f"An error occurred while reading {file_name}: {e}")
-        raise pd.errors.ParserError("Failed to read the dataset")
-    return df
+        # If not utf-8, assume ISO-8859-1 encoding
+        return 'latin-1'
+    return 'utf-8'
 
 
-def get_raw_data(antenna_path, params_path):
-    """Extract the raw data from the relevant csv"""
-    # Initialise list of required columns from antenna data
-    antenna_cols = [
-        'id', 'NGR', 'Site Height',
-        'In-Use Ae Ht', 'In-Use ERP Total'
-    ]
-    # Read in raw data sets, assume UTF-8 encoding
+def custom_decode(file_path, usecols=None):
+    """
+    Read the csv from disk once, detect its encoding and
+    stream the transcoded data into the parser
+    """
+    # Get relevant path variables
+    file_name = os.path.splitext(os.path.basename(file_path))[0]
+    with open(file_path, 'rb') as file:
+        raw_bytes = file.read()
+    encoding = detect_encoding(raw_bytes)
     try:
-        df_antenna = pd.read_csv(
-            antenna_path,
-            usecols=antenna_cols,
+        df = pd.read_csv(
+            io.TextIOWrapper(io.BytesIO(raw_bytes), encoding=encoding),
+            usecols=usecols,
             dtype='str'
         )
     except UnicodeDecodeError:
-        print(f'Decoding error when reading Antenna dataset:\n{error}')
-        df_antenna = pd.read_csv(
-            antenna_path,
-            usecols=antenna_cols,
-            dtype='str',
-            encoding='latin-1'
+        # The sample looked like utf-8 but later bytes do not decode
+        encoding = 'latin-1'
+        df = pd.read_csv(
+            io.TextIOWrapper(io.BytesIO(raw_bytes), encoding=encoding),
+            usecols=usecols,
+            dtype='str'
         )
-        df_antenna = custom_decode(antenna_path)
-    try:
-        df_params = pd.read_csv(params_path, dtype='str')
-    except UnicodeDecodeError as error:
-        print(f'Decoding error when reading Params dataset:\n{error}')
-        df_params = custom_decode(params_path)
+    except Exception as e:
+        print(f"Unable to parse {file_name} dataset: {e}")
+        raise pd.errors.ParserError("Failed to parse the dataset")
+    print(f"Read {file_name} dataset with {encoding} encoding")
+    return df
+
 
-    # Merge the antennas and params dataframes on id
-    df = df_antenna.merge(df_params, how='left', on='id', validate='1:1')
+def read_antenna_data(antenna_path):
+    """Read the columns required from the antenna data"""
+    return custom_decode(antenna_path, usecols=ANTENNA_COLS)
+
+
+def merge_raw_data(df_antenna, df_params):
+    """
+    Merge the antennas and params dataframes on id. A repeated id is
+    not an error here, its rows are rejected by the validation rules
+    """
+    # Rows repeated within a file are the same record, dropped before
+    # the merge so they do not multiply the rows sharing their id
+    df_antenna = df_antenna.drop_duplicates()
+    df_params = df_params.drop_duplicates()
+    df = df_antenna.merge(df_params, how='left', on='id')
     return df
 
 
+def get_raw_data(antenna_path, params_path):
+    """Extract the raw data from the relevant csv"""
+    # Read in raw data sets, each file is read from disk once
+    df_antenna = read_antenna_data(antenna_path)
+    df_params = custom_decode(params_path)
+    return merge_raw_data(df_antenna, df_params)
+
+
+# Supported date formats and the patterns used to classify each value
+DATE_FORMATS = {
+    # The expected British format
+    '%d/%m/%Y': r'^\d{1,2}/\d{1,2}/\d{4}$',
+    # ISO 8601 date and time format
+    '%Y-%m-%d %H:%M:%S': r'^\d{4}-\d{1,2}-\d{1,2} \d{1,2}:\d{2}:\d{2}$',
+    # ISO 8601 date only
+    '%Y-%m-%d': r'^\d{4}-\d{1,2}-\d{1,2}$',
+    # Allow dashes
+    '%d-%m-%Y': r'^\d{1,2}-\d{1,2}-\d{4}$',
+}
+
+
 def format_dates(df):
-    """Format the date column by parsing to datetime"""
-    try:
-        # Try the expected British format
-        df['Date'] = pd.to_datetime(df['Date'], format='%d/%m/%Y')
-    except ValueError:
-        try:
-            # Allow ISO 8601 date and time format
-            df['Date'] = pd.to_datetime(df['Date'], format='%Y-%m-%d %H:%M:%S')
-        except ValueError:
-            try:
-                # Allow dashes
-                df['Date'] = pd.to_datetime(df['Date'], format='%d-%m-%Y')
-            except ValueError as e:
-                print(f'Unsupported date format: {e}')
+    """
+    Format the date column by parsing to datetime. Each distinct date
+    is parsed once with the format matching its pattern
+    """
+    if pd.api.types.is_datetime64_any_dtype(df['Date']):
+        return df
+    # Parse the distinct values only, codes map them back to the rows
+    codes, uniques = pd.factorize(df['Date'])
+    uniques = pd.Series(uniques, dtype='str')
+    parsed = pd.Series(pd.NaT, index=uniques.index, dtype='datetime64[ns]')
+    unmatched = pd.Series(True, index=uniques.index)
+    for date_format, pattern in DATE_FORMATS.items():
+        # Classify the distinct values belonging to this format
+        mask = unmatched & uniques.str.match(pattern)
+        if mask.any():
+            parsed[mask] = pd.to_datetime(
+                uniques[mask], format=date_format, errors='coerce'
+            )
+            unmatched &= ~mask
+    # Report values which could not be parsed rather than failing the column
+    invalid = uniques[parsed.isna()]
+    if not invalid.empty:
+        print(
+            f'Unsupported date format for {len(invalid)} values: '
+            f'{", ".join(invalid.head(5))}'
+        )
+    # Missing dates have code -1 and remain NaT
+    dates = np.full(len(codes), np.datetime64('NaT'), dtype='datetime64[ns]')
+    present = codes >= 0
+    dates[present] = parsed.to_numpy()[codes[present]]
+    df['Date'] = dates
     return df
 
 
@@ -84,21 +166,18 @@ def type_cast(df):
     """
     # Parse dates
     df = format_dates(df)
-    # Convert to integer columns
-    df['id'] = df['id'].astype(int)
-    df['Site Height'] = df['Site Height'].astype(int)
-    df['In-Use Ae Ht'] = df['In-Use Ae Ht'].astype(int)
-    # Convert to float columns
-    df['In-Use ERP Total'] = df['In-Use ERP Total'].astype(float)
+    # Convert to numeric columns, invalid values are left
+    # missing to be rejected by validation rather than failing the upload
+    for col in ['id', 'Site Height', 'In-Use Ae Ht', 'In-Use ERP Total']:
+        df[col] = pd.to_numeric(df[col], errors='coerce')
     return df
 
 
 def clean_data(df):
     """Standardise values and remove anomalies"""
-    # Duplicates have undesirable impacts on visualisations
-    df = df.drop_duplicates()
-    # Strip extra whitespace from column names
-    df.columns = [col.strip() for col in df.columns]
+    # Strip extra whitespace from column names, a new frame is
+    # returned as the input may be a cached stage output
+    df = df.rename(columns=lambda col: col.strip())
     df = df.rename({'Freq.': 'Freq'}, axis=1)
     # Remove commas from Power values
     df['In-Use ERP Total'] = df['In-Use ERP Total'].str.replace(',', '')
@@ -114,34 +193,61 @@ def clean_data(df):
     return df
 
 
-def remove_invalid_stations(df):
-    """Remove DAB Radio stations that have invalid NGR"""
-    # Specify invalid NGRs to drop records
-    invalid_ngr = ('NZ02553847', 'SE213515', 'NT05399374', 'NT25265908')
-    df_filtered = df[~df['NGR'].isin(invalid_ngr)].reset_index()
-    return df_filtered
+def remove_invalid_stations(df, invalid_ngr=INVALID_NGR):
+    """
+    Remove DAB Radio stations which fail the validation rules,
+    including those with a known invalid NGR.
+    Returns the valid stations and the rejected stations with reasons
+    """
+    df_valid, df_rejected = validation.apply_rules(
+        df, validation.get_rules(invalid_ngr)
+    )
+    df_valid = df_valid.reset_index(drop=True)
+    # Convert to integer columns now the missing values are removed
+    for col in ['id', 'Site Height', 'Aerial height(m)']:
+        if pd.api.types.is_float_dtype(df_valid[col]):
+            df_valid[col] = df_valid[col].astype(int)
+    return df_valid, df_rejected
+
 
+def get_valid_stations(validated):
+    """Get the valid stations from the validation output"""
+    df_valid, df_rejected = validated
+    return df_valid
 
-def wrangle_dab_multiplex(df):
+
+def report_rejected_stations(validated, input_path):
     """
-    Extract DAB multiplex blocks C18A, C18F and C188 into their
-    own columns and drop records that don't have these EID values
+    Write the stations rejected by validation to a side report.
+    Returns the number of rejected stations and the report path
     """
-    # Initialise list of required DAB multiplexes
-    dab_multiplexes = ['C18A', 'C18F', 'C188']
-    # Create a column indicating the presence of each multiplex
-    for multiplex in dab_multiplexes:
-        df[multiplex] = df["EID"].apply(
-            lambda x: multiplex
-            if x == multiplex
-            else ''
-        )
+    df_valid, df_rejected = validated
+    report_path = validation.write_rejection_report(df_rejected, input_path)
+    return len(df_rejected), report_path
+
+
+def wrangle_dab_multiplex(df, dab_multiplexes=DAB_MULTIPLEXES):
+    """
+    Extract the requested DAB multiplex blocks, by default C18A, C18F and
+    C188, into their own columns and drop records without these EID values
+    """
+    # Create a column indicating the presence of each multiplex.
+    # A new frame is returned as the input may be a cached stage output
+    df = df.assign(**{
+        multiplex: np.where(df['EID'] == multiplex, multiplex, '')
+        for multiplex in dab_multiplexes
+    })
     # Remove records not in the list of EIDs required for output
-    df_out = df[df[dab_multiplexes].any(axis=1)]
+    df_out = df[df[list(dab_multiplexes)].any(axis=1)]
     return df_out
 
 
-def get_output_columns(df):
+def get_output_column_names(dab_multiplexes=DAB_MULTIPLEXES):
+    """Get the columns required for output including the multiplex flags"""
+    return [*STATION_COLUMNS[:2], *dab_multiplexes, *STATION_COLUMNS[2:]]
+
+
+def get_output_columns(df, dab_multiplexes=DAB_MULTIPLEXES):
     """Remove columns that are not required for output"""
     # Rename columns according to client brief
     df = df.rename(
@@ -151,19 +257,52 @@ def get_output_columns(df):
         },
         axis=1
     )
-    # Initialise list of columns required for output
-    keep_cols = [
-        'id', 'NGR', 'C18A', 'C18F', 'C188', 'Site', 'Site Height',
-        'Aerial height(m)', 'Power(kW)', 'Date', 'Freq',
-        'Block', 'Serv Label1', 'Serv Label2', 'Serv Label3',
-        'Serv Label4', 'Serv Label10',
-    ]
     # Get subset of dataframe with required columns
-    df_out = df[keep_cols]
+    df_out = df[get_output_column_names(dab_multiplexes)]
     return df_out
 
 
-def format_json(df):
+def get_fingerprints(df, columns):
+    """
+    Hash the normalised output columns of each record into a
+    64-bit fingerprint which identifies it across uploads
+    """
+    values = df[columns].copy()
+    for col in values.columns:
+        # Hash numbers the same whether they were parsed as int or float
+        if pd.api.types.is_numeric_dtype(values[col]):
+            values[col] = values[col].astype('float64')
+        # Empty strings are missing values, masked so the dtype is kept
+        elif values[col].dtype == object:
+            values[col] = values[col].mask(values[col] == '')
+    fingerprints = pd.util.hash_pandas_object(values, index=False)
+    # MongoDB stores signed 64-bit integers
+    return fingerprints.to_numpy().view('int64')
+
+
+def get_release_fingerprints(fingerprints, release):
+    """
+    Combine record fingerprints with their release, so records are
+    only duplicates of records in the same release
+    """
+    values = pd.DataFrame({'Fingerprint': fingerprints, 'Release': release})
+    fingerprints = pd.util.hash_pandas_object(values, index=False)
+    return fingerprints.to_numpy().view('int64')
+
+
+def drop_duplicate_stations(df, dab_multiplexes=DAB_MULTIPLEXES):
+    """
+    Remove duplicate records by their fingerprint. Records already stored
+    are skipped by the unique fingerprint index when appending
+    """
+    # Duplicates have undesirable impacts on visualisations
+    columns = get_output_column_names(dab_multiplexes)
+    df = df.assign(Fingerprint=get_fingerprints(df, columns))
+    df_out = df[~df['Fingerprint'].duplicated()]
+    return df_out
+
+
+def format_json(df, dab_multiplexes=DAB_MULTIPLEXES):
     """
     Convert data into a dictionary ready to accurately
     upload to the radio_data MongoDB database
@@ -175,9 +314,7 @@ def format_json(df):
         entry = {
             '_id': row['id'],
             'Date': row['Date'],
-            'C18A': row['C18A'],
-            'C18F': row['C18F'],
-            'C188': row['C188'],
+            **{multiplex: row[multiplex] for multiplex in dab_multiplexes},
             'Site Info': {
                 'NGR': row['NGR'],
                 'Site': row['Site'],
@@ -195,6 +332,12 @@ def format_json(df):
                 'Serv Label10': row['Serv Label10'],
             }
         }
+        # Keep the release of batch uploaded data
+        if 'Release' in row:
+            entry['Release'] = row['Release']
+        # Fingerprint used to skip records already stored
+        if 'Fingerprint' in row:
+            entry['_fingerprint'] = int(row['Fingerprint'])
         # Replace empty strings with None in the dictionary
         entry = {key: value if value not in ['', np.nan]
                   else None for key, value in entry.items()}
@@ -202,19 +345,158 @@ def format_json(df):
     return data
 
 
-def handler(antenna_path, params_path):
-    """Main function oversees the data formatting process"""
-    # Read in raw csvs and merge data sets on id
-    df = get_raw_data(antenna_path, params_path)
+def get_file_key(file_path):
+    """Identify an input file by its path, modification time and size"""
+    stat = os.stat(file_path)
+    return (os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+
+
+def get_stage_keys(inputs, config):
+    """
+    Key each stage by its name, its configuration and the keys of its
+    inputs, so a change only invalidates the stages downstream of it
+    """
+    keys = {name: get_file_key(path) for name, path in inputs.items()}
+    for name, (func, input_names, config_keys) in PIPELINE.items():
+        stage_key = (
+            name,
+            [keys[input_name] for input_name in input_names],
+            [(config_key, config[config_key]) for config_key in config_keys],
+        )
+        keys[name] = hashlib.sha256(repr(stage_key).encode()).hexdigest()
+    return keys
+
+
+def cache_stage_output(key, output):
+    """Store a stage output, evicting the least recently used"""
+    stage_cache[key] = output
+    stage_cache.move_to_end(key)
+    while len(stage_cache) > STAGE_CACHE_SIZE:
+        stage_cache.popitem(last=False)
+
+
+def run_pipeline(inputs, config=None, cache=True):
+    """
+    Run the stages of the pipeline, reusing cached outputs and running
+    stages whose inputs are ready concurrently. Returns every stage output.
+    Without cache the outputs are neither reused nor stored
+    """
+    config = {**DEFAULT_CONFIG, **(config or {})}
+    keys = get_stage_keys(inputs, config)
+    results = dict(inputs)
+    running = {}
+    with ThreadPoolExecutor() as executor:
+        while any(name not in results for name in PIPELINE):
+            # PIPELINE is in dependency order so cache hits chain in one pass
+            for name, (func, input_names, config_keys) in PIPELINE.items():
+                if name in results or name in running.values():
+                    continue
+                if not all(input_name in results for input_name in input_names):
+                    continue
+                if cache and keys[name] in stage_cache:
+                    results[name] = stage_cache[keys[name]]
+                    stage_cache.move_to_end(keys[name])
+                    continue
+                future = executor.submit(
+                    func,
+                    *[results[input_name] for input_name in input_names],
+                    **{config_key: config[config_key] for config_key in config_keys}
+                )
+                running[future] = name
+            if not running:
+                continue
+            # Collect the stages as they finish
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name] = future.result()
+                if cache:
+                    cache_stage_output(keys[name], results[name])
+    return results
+
+
+def json_handler(json_path, invalid_ngr=INVALID_NGR):
+    """
+    Validate and format a json file in the
+    'formatted_data' MongoDB collection format.
+    Returns the documents and the number of rejected rows with the
+    path of their report. Raises a ValueError if a required column is missing
+    """
+    with open(json_path, 'r') as file:
+        data = json.load(file)
+    # Flatten the nested keys
+    df = pd.json_normalize(data)
+    df = df.rename({'_id': 'id'}, axis=1)
+    # Remove prefixes where the data was stored in a nested dictionary
+    df.columns = [
+        mongodb_interaction.clean_column_name(col)
+        for col in df.columns
+    ]
+    # Check columns are as expected before any are used
+    validation.check_columns(
+        df, [*validation.REQUIRED_COLUMNS, *DAB_MULTIPLEXES]
+    )
+    # Ensure date is datetime
+    df = format_dates(df)
+    # Remove duplicate records by fingerprinting the output columns
+    df = drop_duplicate_stations(df)
+    # Quarantine records which fail validation
+    validated = remove_invalid_stations(df, invalid_ngr)
+    rejected = report_rejected_stations(validated, json_path)
+    # Get subset of data required for visualisations
+    upload_data = format_json(get_valid_stations(validated))
+    return upload_data, rejected
+
+
+def copy_documents(upload_data):
+    """Copy the documents and their nested fields"""
+    return [
+        {
+            key: dict(value) if isinstance(value, dict) else value
+            for key, value in entry.items()
+        }
+        for entry in upload_data
+    ]
+
+
+def handler(antenna_path, params_path, config=None, cache=True):
+    """
+    Main function oversees the data formatting process.
+    config overrides DEFAULT_CONFIG e.g. {'invalid_ngr': (...)}.
+    cache reuses the stage outputs of earlier calls in this process,
+    which only helps when the same files are formatted again.
+    Returns the documents and the number of rejected rows with the
+    path of their report
+    """
+    inputs = {'antenna_path': antenna_path, 'params_path': params_path}
+    results = run_pipeline(inputs, config, cache)
+    # The dataframe converted to json, copied so callers
+    # changing the documents do not change the cached output
+    upload_data = results['json']
+    if cache:
+        upload_data = copy_documents(upload_data)
+    return upload_data, results['report']
+
+
+# Stages of the formatting pipeline in dependency order:
+# name -> (function, names of its inputs, configuration keys)
+PIPELINE = {
+    # Read in raw csvs concurrently and merge data sets on id
+    'antenna': (read_antenna_data, ['antenna_path'], []),
+    'params': (custom_decode, ['params_path'], []),
+    'raw': (merge_raw_data, ['antenna', 'params'], []),
     # Standardise values and general cleaning
-    df = clean_data(df)
-    # Remove records with NGR: 'NZ02553847', 'SE213515', 'NT05399374', 'NT25265908'
-    df = remove_invalid_stations(df)
-    # Extract records with DAB multiplexes: 'C18A', 'C18F' and 'C188'
-    df = wrangle_dab_multiplex(df)
+    'clean': (clean_data, ['raw'], []),
+    # Extract records with the configured DAB multiplexes
+    'multiplex': (wrangle_dab_multiplex, ['clean'], ['dab_multiplexes']),
     # Get subset of dataframe with required columns
-    df_out = get_output_columns(df)
+    'output': (get_output_columns, ['multiplex'], ['dab_multiplexes']),
+    # Remove duplicate records by fingerprinting the output columns
+    'deduplicated': (drop_duplicate_stations, ['output'], ['dab_multiplexes']),
+    # Quarantine records which fail validation, including invalid NGRs
+    'validated': (remove_invalid_stations, ['deduplicated'], ['invalid_ngr']),
+    'valid': (get_valid_stations, ['validated'], []),
+    'report': (report_rejected_stations, ['validated', 'antenna_path'], []),
     # Convert the dataframe to json
-    upload_data = format_json(df_out)
-    return upload_data
-
+    'json': (format_json, ['valid'], ['dab_multiplexes']),
+}
@@ -1,15 +1,44 @@
 import os
+import importlib
+import threading
 import tkinter as tk
 from tkinter import ttk
 from tkinter import filedialog
 from tkinter import messagebox
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import pandas as pd
-import json
 
-import formatting
-import mongodb_interaction
-import visualisations
+# Modules which import pandas, matplotlib, seaborn or pymongo.
+# These are imported on first use so the window appears without them
+HEAVY_MODULES = (
+    'formatting',
+    'mongodb_interaction',
+    'visualisations',
+    'batch_ingest',
+    'matplotlib.backends.backend_tkagg',
+)
+
+
+def warm_imports():
+    """Import the heavy modules so the first button click is fast"""
+    for module in HEAVY_MODULES:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            print(f'Unable to import {module}: {e}')
+
+
+def get_rejection_message(rejections):
+    """
+    Describe the rows quarantined by validation and where their reports
+    are, from {release: (rejected rows, report path)}
+    """
+    lines = [
+        f"\n{f'{release}: ' if release else ''}{count} rows were rejected, "
+        f"see {report_path}"
+        for release, (count, report_path) in sorted(rejections.items())
+        if count
+    ]
+    return "\n" + "".join(lines) if lines else ""
+
 
 class RadioDataVisualisation:
     def __init__(self, root):
@@ -20,10 +49,23 @@ class RadioDataVisualisation:
         self.root.configure(bg="light blue")
         self.configure_style()
         self.selected_visualisation = tk.StringVar()
+        self.selected_frequency = tk.StringVar()
         self.c18a_var = tk.BooleanVar()
         self.c18f_var = tk.BooleanVar()
         self.c188_var = tk.BooleanVar()
+        self.significance_var = tk.BooleanVar()
+        # Data loaded for the visualisations, its DAB multiplex index
+        # and the version of the stored data it was retrieved at
+        self.df = None
+        self.multiplex_index = None
+        self.data_version = None
         self.create_widgets()
+        # Warm the heavy imports in the background once the window is shown
+        self.root.after_idle(self.start_warm_imports)
+
+    def start_warm_imports(self):
+        """Import the heavy modules in a background thread"""
+        threading.Thread(target=warm_imports, daemon=True).start()
 
     def configure_style(self):
         # Configure the background color to light blue
@@ -79,6 +121,14 @@ class RadioDataVisualisation:
         )
         upload_json_button.grid(row=1, column=2, pady=(0,2))
 
+        # Batch Upload button for a directory of monthly releases
+        batch_upload_button = ttk.Button(
+            self.root, text="Batch Upload",
+            padding=(10, 5), width=20,
+            command=self.batch_upload
+        )
+        batch_upload_button.grid(row=2, column=1, padx=(0, 5), pady=(0, 2))
+
     def create_dab_checkbuttons(self):
         """
         Provide checkbuttons to determine which DAB multiplexes
@@ -128,7 +178,9 @@ class RadioDataVisualisation:
             values=[
                 "Summary Statistics",
                 "Other Bar Graphs",
-                "Correlation"
+                "Correlation",
+                "Power Over Time",
+                "Height vs Power Density",
             ],
             textvariable=self.selected_visualisation,
             state="readonly"
@@ -137,6 +189,32 @@ class RadioDataVisualisation:
         # Set to the client's initial information needs
         visualisation_options.set("Summary Statistics")
 
+    def create_frequency_combobox(self):
+        """
+        Create a combobox to choose the period the
+        Power Over Time visualisation is resampled by
+        """
+        frequency_label = tk.Label(
+            self.visualisation_frame,
+            background="light blue",
+            text="Resample by:"
+        )
+        frequency_label.grid(
+            row=1, column=1, columnspan=3, padx=5,
+            pady=(10,2), sticky="w"
+        )
+        frequency_options = ttk.Combobox(
+            self.visualisation_frame,
+            values=["Month", "Year"],
+            textvariable=self.selected_frequency,
+            state="readonly", width=8
+        )
+        frequency_options.grid(
+            row=2, column=1, columnspan=3, padx=5,
+            pady=(2,50), sticky="w"
+        )
+        frequency_options.set("Month")
+
     def create_vars_listbox(self):
         """
         Create a listbox containing the variables
@@ -161,6 +239,15 @@ class RadioDataVisualisation:
         ]
         for variable in variables:
             self.variables_listbox.insert(tk.END, variable)
+        # Option to mask associations which are not significant
+        significance_checkbox = ttk.Checkbutton(
+            self.visualisation_frame, style="Custom.TCheckbutton",
+            text="Significant only", variable=self.significance_var
+        )
+        significance_checkbox.grid(
+            row=4, column=1, columnspan=3,
+            padx=5, pady=2, sticky="nw"
+        )
 
     def create_generate_button(self):
         """Create a button to allow visualisations to be displayed"""
@@ -194,6 +281,8 @@ class RadioDataVisualisation:
         self.create_dab_checkbuttons()
         # Provide visualisation type options
         self.create_vis_combobox()
+        # Provide the resampling period options
+        self.create_frequency_combobox()
         # Provide variables options
         self.create_vars_listbox()
         # Create generate button to display visualisations
@@ -260,15 +349,63 @@ class RadioDataVisualisation:
         antenna_path, params_path = self.get_csv_files()
         # Check the correct files have been chosen
         if antenna_path:
-            upload_data = formatting.handler(antenna_path, params_path)
+            import formatting
+            import mongodb_interaction
+            upload_data, rejected = formatting.handler(antenna_path, params_path)
             # Upload the data to the formatted_data collection
             mongodb_interaction.upload_to_mongo(upload_data)
+            # Reload the data for the next visualisation
+            self.df = None
             # Give feedback to the user notifying successful upload
             messagebox.showinfo(
                 "Success!",
                 "Your data has been uploaded.\n"
                 "Please proceed to the Data Visualisations tab."
+                + get_rejection_message({'': rejected})
+            )
+
+    def batch_upload(self):
+        """Clean and upload every Antenna/Params release in a directory"""
+        # Request the directory containing the releases
+        directory = filedialog.askdirectory(
+            initialdir=os.getcwd(),
+            title="Select the directory of releases"
+        )
+        if not directory:
+            return
+        import batch_ingest
+        import mongodb_interaction
+        upload_data, failures, rejections = batch_ingest.handler(directory)
+        # The upload replaces the stored data, so stop rather than
+        # dropping the releases which failed
+        if failures:
+            messagebox.showerror(
+                "Releases failed",
+                "Nothing has been uploaded as these releases "
+                "could not be formatted:\n" + "\n".join(
+                    f"{release}: {error}"
+                    for release, error in sorted(failures.items())
+                )
             )
+            return
+        if not upload_data:
+            messagebox.showerror(
+                "No releases found",
+                "Please ensure the directory contains matching "
+                "TxAntennaDAB and TxParamsDAB csv files."
+            )
+            return
+        # Upload the merged releases to the formatted_data collection
+        mongodb_interaction.upload_to_mongo(upload_data)
+        # Reload the data for the next visualisation
+        self.df = None
+        # Give feedback to the user notifying successful upload
+        messagebox.showinfo(
+            "Success!",
+            "Your releases have been uploaded.\n"
+            "Please proceed to the Data Visualisations tab."
+            + get_rejection_message(rejections)
+        )
 
     def get_json_file(self):
         """Read the formatted json file"""
@@ -285,47 +422,30 @@ class RadioDataVisualisation:
         # Retrieve the json file path
         json_input_file = self.get_json_file()
         if json_input_file:
-            # Load the JSON data
-            # Assume the clean file is in the MongoDB format
-            with open(json_input_file, 'r') as file:
-                data = json.load(file)
-            # Flatten the nested keys
-            df = pd.json_normalize(data)
-            # Check columns are as expected
-            if list(df.columns) != [
-                '_id', 'Date', 'C18A', 'C18F', 'C188',
-                'Aerial height(m)', 'Power(kW)',
-                'Freq', 'Block', 'Site Info.NGR',
-                'Site Info.Site', 'Site Info.Site Height',
-                'Service Labels.Serv Label1',
-                'Service Labels.Serv Label2',
-                'Service Labels.Serv Label3',
-                'Service Labels.Serv Label4', 
-                'Service Labels.Serv Label10',
-            ]:
+            import formatting
+            import mongodb_interaction
+            # Assume the clean file is in the MongoDB format,
+            # rows failing validation are written to a side report
+            try:
+                upload_data, rejected = formatting.json_handler(json_input_file)
+            except ValueError:
+                # Check columns are as expected
                 messagebox.showerror(
                     "Incorrect data format", "Please ensure "
                     "JSON file is formatted as it is in the "
                     "'formatted_data' MongoDB collection."
                 )
                 return
-            df.rename({'_id': 'id'}, axis=1, inplace=True)
-            # Remove prefixes where the data was stored in a nested dictionary
-            df.columns = [
-                mongodb_interaction.clean_column_name(col)
-                for col in df.columns
-            ]
-            # Ensure date is datetime
-            df = formatting.format_dates(df)
-            # Get subset of data required for visualisations
-            upload_data = formatting.format_json(df)
             # Upload the data to the formatted_data collection
             mongodb_interaction.upload_to_mongo(upload_data)
+            # Reload the data for the next visualisation
+            self.df = None
             # Give feedback to the user notifying successful upload
             messagebox.showinfo(
                 "Success!", 
                 "Your JSON file has been uploaded.\n"
                 "Please proceed to the Data Visualizations tab."
+                + get_rejection_message({'': rejected})
             )
         else:
             # Give feedback to the user notifying unsuccessful upload
@@ -365,11 +485,23 @@ class RadioDataVisualisation:
             "C188": self.c188_var.get(),
             "visualisation": self.selected_visualisation.get(),
             "columns": selected_vars,
+            "significance": self.significance_var.get(),
+            "frequency": self.selected_frequency.get(),
         }
-        # Get the data from MongoDB
-        df = mongodb_interaction.retrieve_from_mongo()
+        import mongodb_interaction
+        import visualisations
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        # Get the data from MongoDB once, selection changes reuse its index
+        # until an upload from anywhere changes the stored version.
+        # The version is read first so a concurrent upload causes a reload
+        data_version = mongodb_interaction.get_data_version()
+        if self.df is None or data_version != self.data_version:
+            self.df, self.multiplex_index = visualisations.index_multiplexes(
+                mongodb_interaction.retrieve_from_mongo()
+            )
+            self.data_version = data_version
         # Create the visualisation in the visualisations module
-        vis = visualisations.handler(df, vis_input)
+        vis = visualisations.handler(self.df, vis_input, self.multiplex_index)
         if not vis:
             messagebox.showerror(
                 "Insufficient data",
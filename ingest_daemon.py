@@ -0,0 +1,249 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import batch_ingest
+import formatting
+import mongodb_interaction
+
+
+def get_file_signature(file_path):
+    """Identify the current version of a file by its size and modification time"""
+    stat = os.stat(file_path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+class IngestDaemon:
+    """
+    Watch a drop directory for Antenna/Params release pairs and json dumps,
+    format them in a bounded worker pool and upload the results.
+    By default a release pair replaces the stored documents of its release
+    and a json dump is added to the stored data. With append every drop is
+    added, with replace every drop replaces the whole collection
+    """
+
+    def __init__(self, directory, debounce=2.0, workers=2, status_file=None,
+                 append=False, replace=False):
+        if append and replace:
+            raise ValueError("append and replace cannot both be set")
+        self.directory = directory
+        self.debounce = debounce
+        self.workers = workers
+        self.status_file = status_file
+        self.append = append
+        self.replace = replace
+        # File path -> (signature, time the signature was first seen)
+        self.seen = {}
+        # File path -> signature which has already been queued
+        self.queued = {}
+        # Jobs waiting for a worker:
+        # (sequence, queue time, name, release, file paths, func, args)
+        self.waiting = []
+        # Running futures -> (sequence, queue time, name, release, file paths)
+        self.running = {}
+        self.sequence = 0
+        # Data replaced by an upload -> sequence of the newest drop uploaded
+        self.last_uploaded = {}
+        self.latencies = []
+
+    def get_stable_files(self):
+        """
+        Get the files whose size and modification time have not changed
+        for the debounce period, so partial writes are not processed
+        """
+        now = time.monotonic()
+        stable = {}
+        for file_name in os.listdir(self.directory):
+            file_path = os.path.join(self.directory, file_name)
+            if not os.path.isfile(file_path) or self.is_status_file(file_path):
+                continue
+            try:
+                signature = get_file_signature(file_path)
+            except FileNotFoundError:
+                continue
+            previous = self.seen.get(file_path)
+            if previous is None or previous[0] != signature:
+                # New or still being written, restart the debounce period
+                self.seen[file_path] = (signature, now)
+            elif now - previous[1] >= self.debounce:
+                stable[file_name] = (file_path, signature)
+        return stable
+
+    def is_status_file(self, file_path):
+        """Check whether the path is the daemon's own status file"""
+        return bool(self.status_file) and (
+            os.path.abspath(file_path) == os.path.abspath(self.status_file)
+        )
+
+    def is_new(self, file_path, signature):
+        """Check whether this version of the file has not been queued"""
+        return self.queued.get(file_path) != signature
+
+    def queue_job(self, name, release, file_paths, func, *args):
+        """Add a job for the files of a release, or None, to the waiting queue"""
+        self.waiting.append(
+            (self.sequence, time.monotonic(), name, release, file_paths,
+             func, args)
+        )
+        self.sequence += 1
+        print(f'Queued {name}, queue depth {self.get_queue_depth()}')
+
+    def scan(self):
+        """Queue jobs for the new stable release pairs and json dumps"""
+        stable = self.get_stable_files()
+        antenna_files = {}
+        params_files = {}
+        for file_name, (file_path, signature) in stable.items():
+            antenna_match = batch_ingest.ANTENNA_PATTERN.match(file_name)
+            params_match = batch_ingest.PARAMS_PATTERN.match(file_name)
+            if antenna_match:
+                release = batch_ingest.get_release_name(antenna_match)
+                antenna_files[release] = (file_path, signature)
+            elif params_match:
+                release = batch_ingest.get_release_name(params_match)
+                params_files[release] = (file_path, signature)
+            elif file_name.lower().endswith('.json'):
+                if self.is_new(file_path, signature):
+                    self.queued[file_path] = signature
+                    self.queue_job(
+                        file_name, None, [file_path],
+                        formatting.json_handler, file_path
+                    )
+        # Wait until both files of a release have arrived
+        for release in antenna_files.keys() & params_files.keys():
+            pair = [antenna_files[release], params_files[release]]
+            if any(self.is_new(*file) for file in pair):
+                for file_path, signature in pair:
+                    self.queued[file_path] = signature
+                file_paths = [file_path for file_path, signature in pair]
+                self.queue_job(
+                    f"release '{release}'", release, file_paths,
+                    batch_ingest.format_release, release, *file_paths
+                )
+
+    def get_queue_depth(self):
+        """Number of jobs waiting or running"""
+        return len(self.waiting) + len(self.running)
+
+    def submit_jobs(self, executor):
+        """Start waiting jobs while workers are free"""
+        while self.waiting and len(self.running) < self.workers:
+            (sequence, arrival, name, release, file_paths,
+             func, args) = self.waiting.pop(0)
+            future = executor.submit(func, *args)
+            self.running[future] = (
+                sequence, arrival, name, release, file_paths
+            )
+
+    def collect_jobs(self, timeout):
+        """Upload the results of finished jobs"""
+        if not self.running:
+            time.sleep(timeout)
+            return
+        done, _ = wait(self.running, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            sequence, arrival, name, release, file_paths = self.running.pop(future)
+            try:
+                upload_data, (rejected_count, report_path) = future.result()
+            except Exception as e:
+                print(f'Unable to format {name}: {e}')
+                continue
+            upload_args, replaced = self.get_upload_args(release)
+            # An older drop finishing after a newer drop which
+            # replaced the same data is not uploaded
+            if replaced is not None and (
+                sequence < self.last_uploaded.get(replaced, -1)
+            ):
+                print(f'Skipping {name}, a newer drop has been uploaded')
+                continue
+            try:
+                mongodb_interaction.upload_to_mongo(upload_data, **upload_args)
+            except Exception as e:
+                print(f'Unable to upload {name}, retrying on the next scan: {e}')
+                # Forget the files so the drop is queued again
+                for file_path in file_paths:
+                    self.queued.pop(file_path, None)
+                continue
+            if replaced is not None:
+                self.last_uploaded[replaced] = max(
+                    self.last_uploaded.get(replaced, -1), sequence
+                )
+            latency = time.monotonic() - arrival
+            self.latencies.append(latency)
+            print(f'Uploaded {name} in {latency:.2f}s')
+            if rejected_count:
+                print(f'{rejected_count} rows of {name} rejected, see {report_path}')
+
+    def get_upload_args(self, release):
+        """
+        Get the upload arguments for a drop of the release, None for a
+        json dump, and the data the upload replaces, None if it only adds
+        """
+        if self.replace:
+            return {}, 'collection'
+        if self.append or release is None:
+            return {'append': True}, None
+        return {'release': release}, ('release', release)
+
+    def write_status(self):
+        """Write the queue depth and job latencies to the status file"""
+        if not self.status_file:
+            return
+        status = {
+            'queue_depth': self.get_queue_depth(),
+            'waiting': len(self.waiting),
+            'running': len(self.running),
+            'jobs_completed': len(self.latencies),
+            'last_latency': self.latencies[-1] if self.latencies else None,
+            'max_latency': max(self.latencies, default=None),
+        }
+        with open(self.status_file, 'w') as file:
+            json.dump(status, file)
+
+    def run(self, interval=1.0):
+        """Poll the directory until interrupted"""
+        print(f'Watching {self.directory}')
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            try:
+                while True:
+                    self.scan()
+                    self.submit_jobs(executor)
+                    self.collect_jobs(interval)
+                    self.write_status()
+            except KeyboardInterrupt:
+                print('Stopping')
+
+
+def get_args():
+    """Parse the command line arguments"""
+    parser = argparse.ArgumentParser(
+        description='Ingest DAB radio data dropped into a directory'
+    )
+    parser.add_argument('directory', help='directory to watch')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='seconds between scans of the directory')
+    parser.add_argument('--debounce', type=float, default=2.0,
+                        help='seconds a file must be unchanged before processing')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='number of formatting worker processes')
+    parser.add_argument('--status-file',
+                        help='json file updated with the queue depth and latency')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--append', action='store_true',
+                      help='add each drop to the stored data, skipping '
+                           'records already stored, instead of replacing '
+                           'the stored documents of its release')
+    mode.add_argument('--replace', action='store_true',
+                      help='replace the whole collection with each drop')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    daemon = IngestDaemon(
+        args.directory, args.debounce, args.workers,
+        args.status_file, args.append, args.replace
+    )
+    daemon.run(args.interval)
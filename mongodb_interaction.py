@@ -1,16 +1,191 @@
-import pymongo
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
 import numpy as np
-from pandas import json_normalize
+
+# Storage backend, 'mongodb' or the embedded 'sqlite' store
+# which allows the app to run without a MongoDB server
+STORAGE_BACKEND = os.environ.get('RADIO_DATA_BACKEND', 'mongodb')
+# Number of documents inserted or decoded per batch
+BATCH_SIZE = 10000
+# Number of threads inserting batches during an upload
+UPLOAD_WORKERS = 4
+# Fields used to filter the documents by DAB multiplex
+INDEXED_FIELDS = ['C18A', 'C18F', 'C188']
+# Field holding the hash of each record's output columns
+FINGERPRINT_FIELD = '_fingerprint'
+DUPLICATE_KEY_ERROR = 11000
+# Collection holding the version of the data written by the last upload
+METADATA_COLLECTION = 'metadata'
+
+# Fixed schema of the flattened output: column -> (document field, dtype).
+# _id is a string as batch releases prefix the station id with the release
+RETRIEVAL_SCHEMA = {
+    '_id': ('_id', 'string'),
+    'Date': ('Date', 'datetime'),
+    'C18A': ('C18A', 'string'),
+    'C18F': ('C18F', 'string'),
+    'C188': ('C188', 'string'),
+    'Aerial height(m)': ('Aerial height(m)', 'float'),
+    'Power(kW)': ('Power(kW)', 'float'),
+    'Freq': ('Freq', 'string'),
+    'Block': ('Block', 'string'),
+    'NGR': ('Site Info.NGR', 'string'),
+    'Site': ('Site Info.Site', 'string'),
+    'Site Height': ('Site Info.Site Height', 'float'),
+    'Serv Label1': ('Service Labels.Serv Label1', 'string'),
+    'Serv Label2': ('Service Labels.Serv Label2', 'string'),
+    'Serv Label3': ('Service Labels.Serv Label3', 'string'),
+    'Serv Label4': ('Service Labels.Serv Label4', 'string'),
+    'Serv Label10': ('Service Labels.Serv Label10', 'string'),
+    'Release': ('Release', 'string'),
+}
+
+
+def use_sqlite():
+    """Check whether the embedded storage backend is selected"""
+    if STORAGE_BACKEND not in ('mongodb', 'sqlite'):
+        raise ValueError(f"Unknown storage backend: {STORAGE_BACKEND}")
+    return STORAGE_BACKEND == 'sqlite'
+
+
+def get_id_collisions(error, documents):
+    """
+    Get the documents of a failed bulk write whose _id is already stored.
+    Documents whose fingerprint is already stored are duplicates and are
+    skipped, any other error is raised
+    """
+    if error.details.get('writeConcernErrors'):
+        raise error
+    collisions = []
+    for write_error in error.details['writeErrors']:
+        key_pattern = write_error.get('keyPattern', {})
+        if write_error['code'] != DUPLICATE_KEY_ERROR:
+            raise error
+        if FINGERPRINT_FIELD in key_pattern:
+            continue
+        if '_id' not in key_pattern:
+            raise error
+        collisions.append(documents[write_error['index']])
+    return collisions
+
+
+def insert_batch(collection, batch):
+    """
+    Insert a batch of documents, order is not required. Documents whose
+    fingerprint is already stored are skipped, documents whose _id is
+    already stored replace the stored document
+    """
+    from pymongo import ReplaceOne
+    from pymongo.errors import BulkWriteError
+    try:
+        collection.insert_many(batch, ordered=False)
+        return
+    except BulkWriteError as e:
+        collisions = get_id_collisions(e, batch)
+    if not collisions:
+        return
+    replacements = [
+        ReplaceOne({'_id': document['_id']}, document, upsert=True)
+        for document in collisions
+    ]
+    try:
+        collection.bulk_write(replacements, ordered=False)
+    except BulkWriteError as e:
+        # Replacements whose fingerprint is already stored are skipped
+        if get_id_collisions(e, collisions):
+            raise
+
+
+def insert_batches(collection, upload_data):
+    """Insert the documents in batches over several worker threads"""
+    batches = [
+        upload_data[start:start + BATCH_SIZE]
+        for start in range(0, len(upload_data), BATCH_SIZE)
+    ]
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        futures = [
+            executor.submit(insert_batch, collection, batch)
+            for batch in batches
+        ]
+        for future in futures:
+            future.result()
 
 
-def upload_to_mongo(upload_data):
-    """Upload the formatted data to MongoDB for later retrieval"""
+def upload_to_mongo(upload_data, append=False, release=None):
+    """
+    Upload the formatted data to MongoDB for later retrieval.
+    The data is loaded into a staging collection which then replaces
+    the live collection, so readers never see partial data.
+    With append the data is added to the live collection instead,
+    skipping records whose fingerprint is already stored.
+    With a release only the stored documents of that release are replaced
+    """
+    if use_sqlite():
+        import sqlite_storage
+        sqlite_storage.upload(upload_data, append, release)
+        return
     collection = connect_to_mongodb()
-    # Delete all current documents in the collection
-    collection.delete_many({})
-    # Insert JSON data into the collection
-    collection.insert_many(upload_data)
+    if append or release is not None:
+        # The unique index is the persistent fingerprint set of the collection
+        collection.create_index(FINGERPRINT_FIELD, unique=True, sparse=True)
+        for field in INDEXED_FIELDS:
+            collection.create_index(field)
+        insert_batches(collection, upload_data)
+        if release is not None:
+            # Remove the documents of the release which are not in this
+            # upload once it is loaded, so the release is never missing
+            collection.delete_many({
+                'Release': release,
+                '_id': {'$nin': [document['_id'] for document in upload_data]},
+            })
+        set_data_version(collection)
+        return
+    db = collection.database
+    # Unique name so concurrent uploads do not share a staging collection
+    staging = db[f"{collection.name}_staging_{uuid.uuid4().hex}"]
+    db.create_collection(staging.name)
+    try:
+        # Duplicates across the uploaded releases are skipped during the load
+        staging.create_index(FINGERPRINT_FIELD, unique=True, sparse=True)
+        # Insert JSON data into the staging collection over several workers
+        insert_batches(staging, upload_data)
+        # Build the remaining indexes once after the load
+        for field in INDEXED_FIELDS:
+            staging.create_index(field)
+        # Replace the live collection in a single rename
+        staging.rename(collection.name, dropTarget=True)
+    except Exception:
+        staging.drop()
+        raise
+    set_data_version(collection)
+
+
+def set_data_version(collection):
+    """Record a new version of the data after each upload"""
+    metadata = collection.database[METADATA_COLLECTION]
+    metadata.replace_one(
+        {'_id': collection.name},
+        {'_id': collection.name, 'version': uuid.uuid4().hex},
+        upsert=True
+    )
+
+
+def get_data_version():
+    """
+    Get the version of the stored data, which changes with every upload.
+    Used to tell whether previously retrieved data is out of date
+    """
+    if use_sqlite():
+        import sqlite_storage
+        return sqlite_storage.get_version()
+    collection = connect_to_mongodb()
+    metadata = collection.database[METADATA_COLLECTION].find_one(
+        {'_id': collection.name}
+    )
+    return metadata['version'] if metadata else None
 
 
 def clean_column_name(column_name):
@@ -19,21 +194,92 @@ def clean_column_name(column_name):
     return cleaned_name
 
 
-def retrieve_from_mongo():
+def get_projection():
+    """
+    Build a projection which flattens the nested fields on the server
+    so each document arrives with the columns of RETRIEVAL_SCHEMA
+    """
+    projection = {}
+    for column, (field, dtype) in RETRIEVAL_SCHEMA.items():
+        if dtype == 'string':
+            projection[column] = {'$toString': f'${field}'}
+        else:
+            projection[column] = f'${field}'
+    return projection
+
+
+def retrieve_arrow(collection, query):
+    """
+    Decode the cursor batches straight into Arrow arrays,
+    the fast retrieval path when pymongoarrow is installed
+    """
+    import pyarrow as pa
+    from pymongoarrow.api import Schema, find_arrow_all
+    arrow_types = {
+        'string': pa.string(),
+        'float': pa.float64(),
+        'datetime': pa.timestamp('ms'),
+    }
+    schema = Schema({
+        column: arrow_types[dtype]
+        for column, (field, dtype) in RETRIEVAL_SCHEMA.items()
+    })
+    table = find_arrow_all(
+        collection, query, schema=schema, projection=get_projection()
+    )
+    df = table.to_pandas()
+    df['Date'] = df['Date'].astype('datetime64[ns]')
+    return df
+
+
+def retrieve_records(collection, query):
+    """
+    Decode the raw cursor batches with the bson C extension and build
+    the columns batch by batch, used where pymongoarrow is not installed
+    """
+    from bson import decode_all
+    columns = list(RETRIEVAL_SCHEMA)
+    batches = [
+        pd.DataFrame.from_records(decode_all(raw_batch), columns=columns)
+        for raw_batch in collection.find_raw_batches(
+            query, get_projection(), batch_size=BATCH_SIZE
+        )
+    ]
+    # An empty result gives an empty frame with the schema columns
+    df = pd.concat(batches, ignore_index=True) if batches else (
+        pd.DataFrame(columns=columns)
+    )
+    for column, (field, dtype) in RETRIEVAL_SCHEMA.items():
+        if dtype == 'float':
+            df[column] = pd.to_numeric(
+                df[column], errors='coerce'
+            ).astype('float64')
+        elif dtype == 'datetime':
+            df[column] = pd.to_datetime(
+                df[column], errors='coerce'
+            ).astype('datetime64[ns]')
+    return df
+
+
+def retrieve_from_mongo(query=None):
     """
     Retrieve the cleaned and formatted data from MongoDB.
-    This will be the input data for data visualisations
+    This will be the input data for data visualisations.
+    An optional equality query filters the documents
     """
+    if use_sqlite():
+        import sqlite_storage
+        return sqlite_storage.retrieve(query)
     collection = connect_to_mongodb()
-    # Get all the documents stored in the MongoDB collection
-    all_documents = collection.find({})
-    document_list = list(all_documents)
-    # Convert list of dictionaries into a dataframe
-    df = json_normalize(document_list)
-    # Remove prefixes where the data was stored in a nested dictionary
-    df.columns = [clean_column_name(col) for col in df.columns]
-    # Replace None with more intuitive np.nan
-    df = df.fillna(value=np.nan)
+    try:
+        df = retrieve_arrow(collection, query or {})
+    except ImportError:
+        df = retrieve_records(collection, query or {})
+    # Replace None with more intuitive np.nan, masked
+    # so a column with every value missing is not downcast
+    for column, (field, dtype) in RETRIEVAL_SCHEMA.items():
+        if dtype == 'string':
+            df[column] = df[column].mask(df[column].isna(), np.nan)
     return df
 
 
@@ -42,9 +288,10 @@ def connect_to_mongodb():
     Connect to the Mongodb server and return the
     collection responsible for storing the formatted data
     """
+    # pymongo is only required when the MongoDB backend is used
+    import pymongo
     # Establish a connection to the MongoDB server
     client = pymongo.MongoClient("mongodb://localhost:27017/")
     db = client["radio_data"]
     collection = db["formatted_data"]
     return collection
-
@@ -0,0 +1,183 @@
+import os
+import sqlite3
+import uuid
+
+import pandas as pd
+import numpy as np
+
+# Local database file used in place of the MongoDB server
+DATABASE_PATH = os.environ.get('RADIO_DATA_SQLITE_PATH', 'radio_data.sqlite')
+TABLE_NAME = 'formatted_data'
+# Table holding the version of the data written by the last upload
+METADATA_TABLE = 'metadata'
+
+# Flattened document fields, nested fields are stored without their prefix
+COLUMNS = [
+    '_id', 'Date', 'C18A', 'C18F', 'C188',
+    'Aerial height(m)', 'Power(kW)', 'Freq', 'Block',
+    'NGR', 'Site', 'Site Height',
+    'Serv Label1', 'Serv Label2', 'Serv Label3',
+    'Serv Label4', 'Serv Label10', 'Release', '_fingerprint',
+]
+# Numeric columns, read as objects when every value is NULL
+FLOAT_COLUMNS = ['Aerial height(m)', 'Power(kW)', 'Site Height']
+
+
+def quote(column):
+    """Quote a column name for use in SQL"""
+    return '"' + column.replace('"', '""') + '"'
+
+
+def to_sql_value(value):
+    """Convert numpy and pandas values to types sqlite3 can store"""
+    if value is None or value is pd.NaT:
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat(sep=' ')
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def flatten_document(document):
+    """Flatten a nested MongoDB style document into a row of COLUMNS"""
+    flat = {}
+    for key, value in document.items():
+        if isinstance(value, dict):
+            flat.update(value)
+        else:
+            flat[key] = value
+    return tuple(to_sql_value(flat.get(column)) for column in COLUMNS)
+
+
+def connect_to_sqlite():
+    """Connect to the local database and ensure the table exists"""
+    connection = sqlite3.connect(DATABASE_PATH)
+    # Readers are not blocked while an upload is written
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(
+        f"CREATE TABLE IF NOT EXISTS {TABLE_NAME} "
+        f"({', '.join(quote(col) for col in COLUMNS)})"
+    )
+    # Add columns missing from a database created by an earlier version
+    existing = [row[1] for row in connection.execute(f"PRAGMA table_info({TABLE_NAME})")]
+    for col in COLUMNS:
+        if col not in existing:
+            connection.execute(f"ALTER TABLE {TABLE_NAME} ADD COLUMN {quote(col)}")
+    # The unique index is the persistent fingerprint set of the table
+    connection.execute(
+        f"CREATE UNIQUE INDEX IF NOT EXISTS {TABLE_NAME}_fingerprint "
+        f"ON {TABLE_NAME} (_fingerprint)"
+    )
+    # _id is unique as in MongoDB, earlier versions stored repeated ids
+    # so only the latest row of each is kept before the index is built
+    id_index = connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?",
+        (f"{TABLE_NAME}_id",)
+    ).fetchone()
+    if id_index is None:
+        with connection:
+            connection.execute(
+                f"DELETE FROM {TABLE_NAME} WHERE rowid NOT IN "
+                f"(SELECT MAX(rowid) FROM {TABLE_NAME} GROUP BY _id)"
+            )
+            connection.execute(
+                f"CREATE UNIQUE INDEX {TABLE_NAME}_id ON {TABLE_NAME} (_id)"
+            )
+    connection.execute(
+        f"CREATE TABLE IF NOT EXISTS {METADATA_TABLE} "
+        f"(name TEXT PRIMARY KEY, version TEXT)"
+    )
+    return connection
+
+
+def upload(upload_data, append=False, release=None):
+    """
+    Replace the stored data with the formatted documents, add them with
+    append or only replace the stored records of a release. Records whose
+    fingerprint is stored are skipped and records whose _id is stored
+    replace the stored record, as in MongoDB
+    """
+    rows = [flatten_document(document) for document in upload_data]
+    placeholders = ', '.join('?' * len(COLUMNS))
+    assignments = ', '.join(f"{quote(col)} = ?" for col in COLUMNS)
+    connection = connect_to_sqlite()
+    try:
+        # Replace the contents in a single transaction,
+        # readers see the previous data until it commits
+        with connection:
+            if release is not None:
+                connection.execute(
+                    f"DELETE FROM {TABLE_NAME} WHERE Release = ?", (release,)
+                )
+            elif not append:
+                connection.execute(f"DELETE FROM {TABLE_NAME}")
+            connection.executemany(
+                f"INSERT OR IGNORE INTO {TABLE_NAME} VALUES ({placeholders})",
+                rows
+            )
+            # Rows ignored for their _id replace the stored row, unless
+            # it is the same record or the new fingerprint is stored
+            fingerprint = COLUMNS.index('_fingerprint')
+            connection.executemany(
+                f"UPDATE OR IGNORE {TABLE_NAME} SET {assignments} "
+                f"WHERE _id = ? AND _fingerprint IS NOT ?",
+                [(*row, row[0], row[fingerprint]) for row in rows]
+            )
+            # New version in the same transaction as the data
+            connection.execute(
+                f"INSERT OR REPLACE INTO {METADATA_TABLE} VALUES (?, ?)",
+                (TABLE_NAME, uuid.uuid4().hex)
+            )
+    finally:
+        connection.close()
+
+
+def get_version():
+    """Get the version of the stored data, which changes with every upload"""
+    connection = connect_to_sqlite()
+    try:
+        row = connection.execute(
+            f"SELECT version FROM {METADATA_TABLE} WHERE name = ?",
+            (TABLE_NAME,)
+        ).fetchone()
+    finally:
+        connection.close()
+    return row[0] if row else None
+
+
+def retrieve(query=None):
+    """
+    Retrieve the stored data, optionally filtered by a MongoDB style
+    equality query such as {'C18A': 'C18A'} or {'Site Info.NGR': ...}
+    """
+    conditions = []
+    params = []
+    for field, value in (query or {}).items():
+        # Nested fields are stored without their prefix
+        column = quote(field.split('.')[-1])
+        if value is None:
+            conditions.append(f"{column} IS NULL")
+        else:
+            conditions.append(f"{column} = ?")
+            params.append(to_sql_value(value))
+    # The fingerprint is only used to detect duplicates
+    columns = ', '.join(quote(col) for col in COLUMNS if col != '_fingerprint')
+    sql = f"SELECT {columns} FROM {TABLE_NAME}"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    connection = connect_to_sqlite()
+    try:
+        df = pd.read_sql_query(sql, connection, params=params,
+                               parse_dates=['Date'])
+    finally:
+        connection.close()
+    for column in FLOAT_COLUMNS:
+        df[column] = df[column].astype('float64')
+    # Replace None with more intuitive np.nan in the text columns,
+    # masked so all missing columns are not downcast
+    for column in df.columns[df.dtypes == object]:
+        df[column] = df[column].mask(df[column].isna(), np.nan)
+    return df
@@ -0,0 +1,68 @@
+import subprocess
+import sys
+
+# Number of fresh interpreters to time for each measurement
+REPEATS = 5
+# Allowed overhead of the app window over a bare Tk window in seconds
+MAX_OVERHEAD = 0.25
+
+TK_ONLY = """
+import time
+start = time.perf_counter()
+import tkinter as tk
+root = tk.Tk()
+root.update()
+print(time.perf_counter() - start)
+root.destroy()
+"""
+
+APP_WINDOW = """
+import sys
+import time
+start = time.perf_counter()
+import tkinter as tk
+import gui_main
+root = tk.Tk()
+app = gui_main.RadioDataVisualisation(root)
+# Report heavy modules imported before the warm-up thread can start
+loaded = [m for m in ('pandas', 'numpy', 'matplotlib', 'seaborn', 'pymongo')
+          if m in sys.modules]
+root.update()
+print(time.perf_counter() - start)
+print(','.join(loaded))
+root.destroy()
+"""
+
+
+def time_snippet(code):
+    """Run the code in a fresh interpreter and return its output lines"""
+    result = subprocess.run(
+        [sys.executable, '-c', code],
+        capture_output=True, text=True, check=True
+    )
+    return result.stdout.splitlines()
+
+
+def handler():
+    """Compare time-to-first-window of the app against Tk alone"""
+    tk_times = [float(time_snippet(TK_ONLY)[0]) for _ in range(REPEATS)]
+    app_times = []
+    for _ in range(REPEATS):
+        output = time_snippet(APP_WINDOW)
+        app_times.append(float(output[0]))
+        # None should be loaded before the window is shown
+        if len(output) > 1 and output[1]:
+            print(f'Heavy modules imported before first window: {output[1]}')
+            return 1
+    tk_best = min(tk_times)
+    app_best = min(app_times)
+    print(f'Tk only:    {tk_best:.3f}s')
+    print(f'App window: {app_best:.3f}s')
+    if app_best - tk_best > MAX_OVERHEAD:
+        print(f'Startup overhead exceeds {MAX_OVERHEAD}s')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(handler())
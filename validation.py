@@ -0,0 +1,125 @@
+import os
+from collections import namedtuple
+
+import pandas as pd
+
+# A rule rejects the rows where its check fails on the column
+Rule = namedtuple('Rule', ['reason', 'column', 'check', 'argument'])
+
+# Station columns which must be present before any rows are validated,
+# the DAB multiplex flag columns depend on the pipeline configuration
+REQUIRED_COLUMNS = [
+    'id', 'NGR', 'Site', 'Site Height',
+    'Aerial height(m)', 'Power(kW)', 'Date', 'Freq',
+    'Block', 'Serv Label1', 'Serv Label2', 'Serv Label3',
+    'Serv Label4', 'Serv Label10',
+]
+
+# Rules applied to the output columns, the known invalid
+# NGRs are supplied by the pipeline configuration
+RULES = [
+    Rule('missing id', 'id', 'not_null', None),
+    Rule('duplicate id', 'id', 'unique', None),
+    Rule('invalid NGR format', 'NGR', 'pattern', r'[A-Z]{2}(?:\d\d){2,5}'),
+    Rule('unparseable date', 'Date', 'not_null', None),
+    Rule('site height out of range', 'Site Height', 'range', (-10, 1500)),
+    Rule('site height not whole', 'Site Height', 'whole', None),
+    Rule('aerial height out of range', 'Aerial height(m)', 'range', (0, 1000)),
+    Rule('aerial height not whole', 'Aerial height(m)', 'whole', None),
+    Rule('power out of range', 'Power(kW)', 'range', (0, 1000)),
+]
+
+
+def check_not_null(values, argument):
+    """Pass rows with a value"""
+    return values.notna()
+
+
+def check_unique(values, argument):
+    """Pass rows whose value is not repeated"""
+    # Every row sharing a value is rejected as the valid one is ambiguous
+    return ~values.duplicated(keep=False)
+
+
+def check_pattern(values, argument):
+    """Pass rows whose value matches the regular expression"""
+    return values.astype('str').str.fullmatch(argument) & values.notna()
+
+
+def check_not_in(values, argument):
+    """Pass rows whose value is not in the list"""
+    return ~values.isin(argument)
+
+
+def check_range(values, argument):
+    """Pass rows whose value is within the inclusive range"""
+    # Missing values are outside every range
+    return values.between(*argument)
+
+
+def check_whole(values, argument):
+    """Pass rows whose value is a whole number"""
+    return values.isna() | (values % 1 == 0)
+
+
+CHECKS = {
+    'not_null': check_not_null,
+    'unique': check_unique,
+    'pattern': check_pattern,
+    'not_in': check_not_in,
+    'range': check_range,
+    'whole': check_whole,
+}
+
+
+def get_rules(invalid_ngr=()):
+    """Get the rule set including the known invalid NGRs"""
+    return [*RULES, Rule('known invalid NGR', 'NGR', 'not_in', tuple(invalid_ngr))]
+
+
+def check_columns(df, required_columns=REQUIRED_COLUMNS):
+    """Raise a ValueError if any required column is missing"""
+    missing = [col for col in required_columns if col not in df.columns]
+    if missing:
+        raise ValueError(f"Missing required columns: {', '.join(missing)}")
+
+
+def apply_rules(df, rules):
+    """
+    Evaluate every rule as a boolean mask in one pass over the data.
+    Returns the valid rows and the rejected rows with their reasons
+    """
+    # Schema check, a missing column invalidates every row
+    check_columns(df)
+    failed = pd.DataFrame(
+        {
+            rule.reason: ~CHECKS[rule.check](df[rule.column], rule.argument)
+            for rule in rules
+        },
+        index=df.index
+    )
+    rejected_mask = failed.any(axis=1)
+    df_rejected = df.loc[rejected_mask].copy()
+    failed = failed.loc[rejected_mask]
+    # Join the reasons of each failed rule, one rule at a time
+    reasons = pd.Series('', index=df_rejected.index)
+    for reason in failed.columns:
+        reasons = reasons.where(~failed[reason], reasons + '; ' + reason)
+    df_rejected['Reasons'] = reasons.str.lstrip('; ')
+    return df.loc[~rejected_mask], df_rejected
+
+
+def write_rejection_report(df_rejected, input_path):
+    """
+    Write the rejected rows to a 'rejected' directory beside the
+    input file and return the path of the report
+    """
+    if df_rejected.empty:
+        return None
+    report_dir = os.path.join(os.path.dirname(input_path), 'rejected')
+    os.makedirs(report_dir, exist_ok=True)
+    file_name = os.path.splitext(os.path.basename(input_path))[0]
+    report_path = os.path.join(report_dir, f'{file_name}_rejected.csv')
+    df_rejected.to_csv(report_path, index=False)
+    print(f'{len(df_rejected)} rows rejected, see {report_path}')
+    return report_path
@@ -1,26 +1,89 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
 import seaborn as sns
 
-
-def format_dataframe(df, vis_input):
+MULTIPLEXES = ['C18A', 'C18F', 'C188']
+# Permutation test of the Cramér's V heatmap
+PERMUTATIONS = 2000
+SIGNIFICANCE_LEVEL = 0.05
+# Maximum permuted labels or table cells held in memory at once
+PERMUTATION_BATCH_CELLS = 5_000_000
+# Relative cost of drawing a table cell from the margins to permuting a record
+MARGIN_CELL_COST = 10
+# The permutations stop early once the p-value estimate is this many
+# standard errors from the significance level, so the decision is settled
+STOPPING_STANDARD_ERRORS = 3
+# Process pool of the permutation tests, started on first use
+permutation_executor = None
+# Period start frequencies used to resample the Date
+RESAMPLE_FREQUENCIES = {'Month': 'MS', 'Year': 'YS'}
+# Number of bins along each axis of the density plots
+DENSITY_BINS = 50
+
+
+def index_multiplexes(df):
+    """
+    Sort the loaded data by DAB multiplex and record the row range of
+    each multiplex, so selections are slices rather than masks.
+    Built once when the data is loaded, returns the sorted data and
+    {multiplex: (start, stop)}. The ranges are positions in the
+    returned frame so they are passed alongside it, not stored on it
+    """
+    # Position of each record's multiplex, records without one go last
+    order = np.full(len(df), len(MULTIPLEXES))
+    for position, mp in enumerate(MULTIPLEXES):
+        order[(df[mp] == mp).to_numpy()] = position
+    sort_order = np.argsort(order, kind='stable')
+    df = df.iloc[sort_order].reset_index(drop=True)
+    bounds = np.searchsorted(order[sort_order], np.arange(len(MULTIPLEXES) + 1))
+    multiplex_index = {
+        mp: (int(bounds[i]), int(bounds[i + 1]))
+        for i, mp in enumerate(MULTIPLEXES)
+    }
+    return df, multiplex_index
+
+
+def get_multiplex_rows(df, mp, multiplex_index=None):
+    """Get the records of one DAB multiplex"""
+    if multiplex_index is None:
+        return df[df[mp] == mp]
+    start, stop = multiplex_index[mp]
+    return df.iloc[start:stop]
+
+
+def format_dataframe(df, vis_input, multiplex_index=None):
     """
     Format the dataframe so that only the data records
-    with the requested DAB multiplexes are processed further
+    with the requested DAB multiplexes are processed further.
+    multiplex_index must come from index_multiplexes of this frame.
+    Returns the selection, the multiplexes and the index of the selection
     """
     # Get the requested DAB Multiplexes
     multiplexes = []
-    for mp in ['C18A', 'C18F', 'C188']:
+    for mp in MULTIPLEXES:
         if vis_input[mp]:
             multiplexes.append(mp)
-    # Subset dataframe to only process required multiplexes
-    df_list = []
-    for mp in multiplexes:
-        df_sub = df.loc[df[mp] == mp].copy()
-        df_list.append(df_sub)
-    df = pd.concat(df_list).reset_index(drop=True)
-    return df, multiplexes
+    if multiplex_index is None:
+        df, multiplex_index = index_multiplexes(df)
+    ranges = [multiplex_index[mp] for mp in multiplexes]
+    # Adjacent multiplexes are a single slice which does not copy the data
+    if all(ranges[i][1] == ranges[i + 1][0] for i in range(len(ranges) - 1)):
+        df_out = df.iloc[ranges[0][0]:ranges[-1][1]]
+    else:
+        positions = np.concatenate([np.arange(*rows) for rows in ranges])
+        df_out = df.take(positions)
+    # Record the row range of each multiplex within the selection
+    selection_index = {}
+    offset = 0
+    for mp, (start, stop) in zip(multiplexes, ranges):
+        selection_index[mp] = (offset, offset + stop - start)
+        offset += stop - start
+    return df_out, multiplexes, selection_index
 
 
 def get_summary_stats(df_mp):
@@ -49,7 +112,7 @@ def get_summary_stats(df_mp):
     return summary_stats
 
 
-def summary_stats_vis(df, multiplexes, figure_size):
+def summary_stats_vis(df, multiplexes, figure_size, multiplex_index=None):
     """
     Produce plot showing the mean, median, and mode of
     Power(kW) for the C18A, C18F, C188 DAB multiplexes where
@@ -58,7 +121,7 @@ def summary_stats_vis(df, multiplexes, figure_size):
     # Create empty dict to store stats for all specified DAB multiplexes
     multiplex_stats = {}
     for multiplex in multiplexes:
-        df_mp = df[df[multiplex]==multiplex].copy()
+        df_mp = get_multiplex_rows(df, multiplex, multiplex_index)
         multiplex_stats[multiplex] = get_summary_stats(df_mp)
 
     sum_stats = ['mean', 'median', 'mode']
@@ -97,26 +160,31 @@ def summary_stats_vis(df, multiplexes, figure_size):
     return fig
 
 
-def get_mp_column(df, multiplexes):
+def get_mp_column(df, multiplexes, multiplex_index=None):
     """
     Create one column to flag all DAB Multiplexes.
     Drop original DAB Multiplex columns
     """
-    df['DAB_Multiplex'] = ''
+    labels = np.full(len(df), '', dtype=object)
     for mp in multiplexes:
-        df.loc[df[mp]==mp, 'DAB_Multiplex'] = mp
-        # Drop the original DAB Multiplex flag
-        df.drop(mp, axis=1, inplace=True)
+        if multiplex_index is None:
+            labels[(df[mp] == mp).to_numpy()] = mp
+        else:
+            start, stop = multiplex_index[mp]
+            labels[start:stop] = mp
+    df['DAB_Multiplex'] = labels
+    # Drop the original DAB Multiplex flags
+    df = df.drop(multiplexes, axis=1)
     return df
 
 
-def other_bar_graphs(df, multiplexes, figure_size):
+def other_bar_graphs(df, multiplexes, figure_size, multiplex_index=None):
     """
     Produce plot showing counts of requested variables'
     values for the requested DAB Multiplexes
     """
     # Create single DAB Multiplex column to facilitate groupby
-    df = get_mp_column(df.copy(), multiplexes)
+    df = get_mp_column(df.copy(), multiplexes, multiplex_index)
     # Pivot "Service Labels" into binary columns
     df = pd.get_dummies(
         df,
@@ -164,63 +232,298 @@ def other_bar_graphs(df, multiplexes, figure_size):
     return fig
 
 
+def encode_pair(x, y):
+    """
+    Integer code the values of two columns, dropping
+    records where either value is missing
+    """
+    x_codes = pd.factorize(x)[0]
+    y_codes = pd.factorize(y)[0]
+    present = (x_codes >= 0) & (y_codes >= 0)
+    # Re-code so only the categories present remain
+    x_codes, x_uniques = pd.factorize(x_codes[present])
+    y_codes, y_uniques = pd.factorize(y_codes[present])
+    return x_codes, y_codes, len(x_uniques), len(y_uniques)
+
+
+def get_chi2(counts):
+    """Chi-squared statistic of a stack of contingency tables"""
+    n = counts.sum(axis=(-2, -1), keepdims=True)
+    expected = (
+        counts.sum(axis=-1, keepdims=True)
+        * counts.sum(axis=-2, keepdims=True)
+        / n
+    )
+    return ((counts - expected) ** 2 / expected).sum(axis=(-2, -1))
+
+
+def get_contingency(x_codes, y_codes, rows, cols):
+    """Count the records in each cell of the contingency table"""
+    counts = np.bincount(x_codes * cols + y_codes, minlength=rows * cols)
+    return counts.reshape(rows, cols)
+
+
 def cramers_v(x, y):
     """Performs the cramers v calculation and returns the result"""
-    confusion_matrix = pd.crosstab(x, y)
-    chi2 = 0
-    n = confusion_matrix.values.sum()
-    rows, cols = confusion_matrix.shape
-
-    for i in range(rows):
-        for j in range(cols):
-            expected = (confusion_matrix.iloc[i].sum() * confusion_matrix.iloc[:, j].sum()) / n
-            chi2 += (confusion_matrix.iloc[i, j] - expected) ** 2 / expected
-
-    cramers_v = np.sqrt(chi2 / (n * (min(rows, cols) - 1)))
-    # Case where Cramer's V has detected no association
-    if np.isnan(cramers_v):
+    x_codes, y_codes, rows, cols = encode_pair(x, y)
+    n = len(x_codes)
+    if n == 0 or min(rows, cols) < 2:
+        # Case where Cramer's V has detected no association
         return 0.0
-    return cramers_v
+    chi2 = get_chi2(get_contingency(x_codes, y_codes, rows, cols))
+    return float(np.sqrt(chi2 / (n * (min(rows, cols) - 1))))
+
+
+def get_permuted_chi2(x_codes, y_codes, row_totals, col_totals, size, rng):
+    """
+    Chi-squared statistics of a batch of permutations of the labels of y,
+    each batch is counted with a single bincount. Only occupied cells are
+    summed, as chi2 = n * (sum of n_ij^2 / (r_i * c_j) - 1) and each record
+    adds n_ij / (r_i * c_j) for its cell
+    """
+    rows, cols = len(row_totals), len(col_totals)
+    permuted = rng.permuted(np.tile(y_codes, (size, 1)), axis=1)
+    # Offset each permutation into its own contingency table
+    cells = (
+        np.arange(size)[:, None] * rows * cols
+        + x_codes * cols
+        + permuted
+    )
+    counts = np.bincount(cells.ravel(), minlength=size * rows * cols)
+    weights = 1 / (row_totals[x_codes] * col_totals[permuted])
+    return len(x_codes) * ((counts[cells] * weights).sum(axis=1) - 1)
+
+
+def sample_tables(row_totals, col_totals, size, rng):
+    """
+    Draw the contingency tables of a batch of permutations straight from
+    the fixed margins, so the cost does not grow with the records.
+    Each row is a multivariate hypergeometric draw from the labels left,
+    drawn one column at a time across the batch
+    """
+    rows, cols = len(row_totals), len(col_totals)
+    counts = np.empty((size, rows, cols), dtype='int64')
+    remaining = np.tile(np.asarray(col_totals, dtype='int64'), (size, 1))
+    for i in range(rows - 1):
+        to_draw = np.full(size, row_totals[i], dtype='int64')
+        # Labels left in the columns after the current one
+        later = remaining.sum(axis=1)
+        for j in range(cols - 1):
+            later -= remaining[:, j]
+            drawn = rng.hypergeometric(remaining[:, j], later, to_draw)
+            counts[:, i, j] = drawn
+            to_draw -= drawn
+        counts[:, i, cols - 1] = to_draw
+        remaining -= counts[:, i]
+    # The last row takes the labels left
+    counts[:, rows - 1] = remaining
+    return counts
+
+
+def permutation_p_value(x, y, permutations=PERMUTATIONS, seed=0,
+                        significance_level=SIGNIFICANCE_LEVEL):
+    """
+    Estimate the p-value of Cramer's V by permuting the labels of y.
+    The permuted tables are drawn from the margins when they are small
+    compared to the records, otherwise the permuted labels are counted.
+    Stops before all the permutations once the p-value is clearly
+    above or below the significance level
+    """
+    x_codes, y_codes, rows, cols = encode_pair(x, y)
+    n = len(x_codes)
+    if n == 0 or min(rows, cols) < 2:
+        return 1.0
+    table = get_contingency(x_codes, y_codes, rows, cols)
+    row_totals, col_totals = table.sum(axis=1), table.sum(axis=0)
+    observed = get_chi2(table)
+    rng = np.random.default_rng(seed)
+    # Drawing a table costs far more per cell than permuting per record
+    from_margins = rows * cols * MARGIN_CELL_COST < n
+    # Bound the memory used by a batch of tables and permuted labels
+    cells = rows * cols if from_margins else max(n, rows * cols)
+    batch_size = max(1, min(permutations, PERMUTATION_BATCH_CELLS // cells))
+    exceeded = 0
+    done = 0
+    for start in range(0, permutations, batch_size):
+        size = min(batch_size, permutations - start)
+        if from_margins:
+            chi2 = get_chi2(sample_tables(row_totals, col_totals, size, rng))
+        else:
+            chi2 = get_permuted_chi2(
+                x_codes, y_codes, row_totals, col_totals, size, rng
+            )
+        # Cramer's V increases with chi-squared as the margins are fixed
+        exceeded += np.count_nonzero(chi2 >= observed * (1 - 1e-12))
+        done += size
+        p_value = (exceeded + 1) / (done + 1)
+        standard_error = np.sqrt(
+            significance_level * (1 - significance_level) / done
+        )
+        if abs(p_value - significance_level) > (
+            STOPPING_STANDARD_ERRORS * standard_error
+        ):
+            break
+    return p_value
+
+
+def get_permutation_executor():
+    """
+    Get the process pool of the permutation tests, started on first
+    use and reused by every heatmap
+    """
+    global permutation_executor
+    if permutation_executor is None:
+        permutation_executor = ProcessPoolExecutor(max_workers=os.cpu_count() or 1)
+    return permutation_executor
+
+
+def get_p_values(df, pairs):
+    """Run the permutation tests of the column pairs over a process pool"""
+    executor = get_permutation_executor()
+    futures = [
+        executor.submit(
+            permutation_p_value,
+            df[col1].to_numpy(), df[col2].to_numpy(),
+            PERMUTATIONS, seed
+        )
+        for seed, (col1, col2) in enumerate(pairs)
+    ]
+    return [future.result() for future in futures]
 
 
-def corr_graph(df, multiplexes, figure_size):
+def corr_graph(df, multiplexes, figure_size, significance=False,
+               multiplex_index=None):
     """
     Produce plot to determine if there is any significant correlation
-    between the requested variables for the requested DAB Multiplexes
+    between the requested variables for the requested DAB Multiplexes.
+    With significance, associations which are not significant
+    under a permutation test are masked
     """
     # Create single DAB Multiplex column to facilitate groupby
-    df = get_mp_column(df.copy(), multiplexes)
+    df = get_mp_column(df.copy(), multiplexes, multiplex_index)
     # Calculate Cramér's V matrix for all pairs of columns
-    cramer_matrix = pd.DataFrame(index=df.columns, columns=df.columns)
-
-    for col1 in df.columns:
-        for col2 in df.columns:
+    cramer_matrix = pd.DataFrame(index=df.columns, columns=df.columns, dtype=float)
+    pairs = []
+    for i, col1 in enumerate(df.columns):
+        for col2 in df.columns[i:]:
             # Case where cramers v would detect a perfect association
             if df[col1].nunique() == 1 and df[col2].nunique() == 1:
-                cramer_matrix.loc[col1, col2] = 1.0
+                value = 1.0
             else:
-                cramer_matrix.loc[col1, col2] = cramers_v(df[col1], df[col2])
+                value = cramers_v(df[col1], df[col2])
+            # The matrix is symmetric so each pair is calculated once
+            cramer_matrix.loc[col1, col2] = value
+            cramer_matrix.loc[col2, col1] = value
+            if col1 != col2:
+                pairs.append((col1, col2))
+
+    mask = None
+    title = "Cramér's V Heatmap"
+    if significance and pairs:
+        p_matrix = pd.DataFrame(0.0, index=df.columns, columns=df.columns)
+        for (col1, col2), p_value in zip(pairs, get_p_values(df, pairs)):
+            p_matrix.loc[col1, col2] = p_value
+            p_matrix.loc[col2, col1] = p_value
+        # Hide the associations which are not significant
+        mask = p_matrix >= SIGNIFICANCE_LEVEL
+        title += (
+            f" (p < {SIGNIFICANCE_LEVEL}, up to {PERMUTATIONS} permutations)"
+        )
 
     # Create a heatmap of Cramér's V values
     plt.figure(figsize=figure_size)
     plt.xticks(rotation=45, ha='right', fontsize=8)
     plt.yticks(fontsize=8)
     plt.subplots_adjust(bottom=0.15)
-    sns.heatmap(cramer_matrix.astype(float), annot=True, cmap='coolwarm', fmt=".2f")
-    plt.title("Cramér's V Heatmap")
+    sns.heatmap(cramer_matrix, annot=True, cmap='coolwarm', fmt=".2f", mask=mask)
+    plt.title(title)
     # Convert the heatmap to a figure
     fig = plt.gcf()
     return fig
 
 
-def handler(df, vis_input):
+def power_over_time(df, multiplexes, figure_size, frequency='Month',
+                    multiplex_index=None):
+    """
+    Produce plot showing the mean Power(kW) and the number of stations
+    over time for the requested DAB Multiplexes, resampled by month or year
+    """
+    # Create single DAB Multiplex column to facilitate groupby
+    df = get_mp_column(df.copy(), multiplexes, multiplex_index)
+    # Data stored by earlier versions may hold unparsed or missing dates
+    df['Date'] = pd.to_datetime(df['Date'], errors='coerce')
+    if df['Date'].isna().all():
+        fig, axes = plt.subplots(1, 2, figsize=figure_size)
+        for ax in axes:
+            ax.text(0.5, 0.5, 'No data', ha='center', va='center',
+                    transform=ax.transAxes)
+        return fig
+    # Bin the records into periods, the plot has one point per period
+    grouped = df.groupby(
+        ['DAB_Multiplex', pd.Grouper(key='Date', freq=RESAMPLE_FREQUENCIES[frequency])]
+    )['Power(kW)']
+    mean_power = grouped.mean().unstack(level=0)
+    station_counts = grouped.count().unstack(level=0)
+
+    fig, axes = plt.subplots(1, 2, figsize=figure_size)
+    mean_power.plot(ax=axes[0], marker='.')
+    axes[0].set_title(f'Mean Power(kW) by {frequency}')
+    axes[0].set_ylabel('Power(kW)')
+    station_counts.plot(ax=axes[1], marker='.')
+    axes[1].set_title(f'Number of Stations by {frequency}')
+    axes[1].set_ylabel('Count')
+    for ax in axes:
+        ax.set_xlabel('Date')
+        ax.legend(title='DAB Multiplex')
+
+    plt.tight_layout()
+    return fig
+
+
+def height_power_density(df, multiplexes, figure_size):
+    """
+    Produce 2-D binned density plots of Site Height and
+    Aerial height(m) against Power(kW) for the requested DAB Multiplexes
+    """
+    fig, axes = plt.subplots(1, 2, figsize=figure_size)
+    for ax, height in zip(axes, ['Site Height', 'Aerial height(m)']):
+        values = df[[height, 'Power(kW)']].dropna()
+        # Count the records in a fixed grid of bins rather than plotting each
+        counts, x_edges, y_edges = np.histogram2d(
+            values[height], values['Power(kW)'], bins=DENSITY_BINS
+        )
+        # Empty bins are left blank
+        counts = np.ma.masked_equal(counts, 0)
+        if counts.count() == 0:
+            # A log scale needs at least one record
+            ax.text(0.5, 0.5, 'No data', ha='center', va='center',
+                    transform=ax.transAxes)
+        else:
+            mesh = ax.pcolormesh(
+                x_edges, y_edges, counts.T,
+                cmap='viridis', norm=LogNorm()
+            )
+            fig.colorbar(mesh, ax=ax, label='Number of Stations')
+        ax.set_xlabel(height)
+        ax.set_ylabel('Power(kW)')
+        ax.set_title(f'{height} against Power(kW)')
+    fig.suptitle(f"DAB Multiplex {', '.join(multiplexes)}")
+
+    plt.tight_layout()
+    return fig
+
+
+def handler(df, vis_input, multiplex_index=None):
     """
     Applies user input parameters to the dataframe
-    and returns a figure of the selected visualisation
+    and returns a figure of the selected visualisation.
+    multiplex_index is the index returned with df by index_multiplexes
     """
     # Get standard figure size
     figure_size = (10, 5)
-    df, multiplexes = format_dataframe(df, vis_input)
+    df, multiplexes, multiplex_index = format_dataframe(
+        df, vis_input, multiplex_index
+    )
     # Do not attempt to generate visualisations where no data is present
     if df.empty:
         return None
@@ -228,16 +531,34 @@ def handler(df, vis_input):
     if vis_input['visualisation'] == "Summary Statistics":
         # Subset the dataframe, take only required columns
         df = df[[*multiplexes, 'Date', 'Site Height', 'Power(kW)']]
-        visualisation = summary_stats_vis(df, multiplexes, figure_size)
+        visualisation = summary_stats_vis(
+            df, multiplexes, figure_size, multiplex_index
+        )
     elif vis_input['visualisation'] == "Other Bar Graphs":
         # Subset the dataframe, take only required columns
         df = df[['Site', *multiplexes, 'Freq', 'Block', 'Serv Label1',
                  'Serv Label2', 'Serv Label3', 'Serv Label4','Serv Label10']]
-        visualisation = other_bar_graphs(df, multiplexes, figure_size)
+        visualisation = other_bar_graphs(
+            df, multiplexes, figure_size, multiplex_index
+        )
     elif vis_input['visualisation'] == "Correlation":
         # Subset the dataframe, take only required columns
         df = df[[*multiplexes, *vis_input['columns']]]
-        visualisation = corr_graph(df, multiplexes, figure_size)
+        visualisation = corr_graph(
+            df, multiplexes, figure_size,
+            vis_input.get('significance', False), multiplex_index
+        )
+    elif vis_input['visualisation'] == "Power Over Time":
+        # Subset the dataframe, take only required columns
+        df = df[[*multiplexes, 'Date', 'Power(kW)']]
+        visualisation = power_over_time(
+            df, multiplexes, figure_size,
+            vis_input.get('frequency', 'Month'), multiplex_index
+        )
+    elif vis_input['visualisation'] == "Height vs Power Density":
+        # Subset the dataframe, take only required columns
+        df = df[['Site Height', 'Aerial height(m)', 'Power(kW)']]
+        visualisation = height_power_density(df, multiplexes, figure_size)
     # Case where an unexpected visualisation has been requested
     else:
         raise KeyError("Unexpected visualisaition requested")